@@ -1,39 +1,96 @@
+import io
 import sys
 
+import numpy as np
 from transformers import AutoTokenizer
 
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
 dataset = sys.argv[1]
 model_name_or_path = sys.argv[2]
 max_len = int(sys.argv[3])
+flush_every = 8192
 
-subword_len_counter = 0
+# Decisions for every input line, see assign_splits
+EMIT, SPLIT, SKIP = 0, 1, 2
 
-tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
 
-with open(dataset, "rt") as f_p:
-    for line in f_p:
-        line = line.rstrip()
+@njit(cache=True)
+def assign_splits(lens, max_len):
+    """Greedily split examples so that no sentence exceeds max_len subwords.
+
+    lens holds the subword length of every line's token, or -1 for the blank line ending an example.
+    """
+    decisions = np.zeros(lens.shape[0], dtype=np.int8)
+    subword_len_counter = 0
+    for i in range(lens.shape[0]):
+        current_subwords_len = lens[i]
         # end of example
-        if not line:
-            print(line)
+        if current_subwords_len < 0:
             subword_len_counter = 0
-            continue
-
-        line = line.split()
-        token, label = line[0], line[-1]
-
-        current_subwords_len = len(tokenizer.tokenize(token))
         # Token contains strange control characters like \x96 or \x95
         # Just filter out the complete line
-        if current_subwords_len == 0:
-            continue
-
-        if (subword_len_counter + current_subwords_len) > max_len:
-            print("")
-            print(token, label)
+        elif current_subwords_len == 0:
+            decisions[i] = SKIP
+        elif (subword_len_counter + current_subwords_len) > max_len:
+            decisions[i] = SPLIT
             subword_len_counter = 0
-            continue
+        else:
+            subword_len_counter += current_subwords_len
+    return decisions
+
+
+tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=True)
+
+with open(dataset, "rt") as f_p:
+    lines = [line.rstrip() for line in f_p]
+
+# Tokenize each distinct token once, in a single batched call, and look the
+# subword lengths up by surface form afterwards
+tokens = list(dict.fromkeys(line.split()[0] for line in lines if line))
+subword_lens = {
+    token: len(ids) for token, ids in zip(tokens, tokenizer(tokens, add_special_tokens=False)["input_ids"])
+}
+
+# Collect output lines and write them in large chunks rather than one print per line
+stdout = io.TextIOWrapper(
+    sys.stdout.buffer,
+    encoding=sys.stdout.encoding,
+    errors=sys.stdout.errors,
+    write_through=False,
+    line_buffering=False,
+)
+out = []
+
+
+def emit(line):
+    out.append(line)
+    if len(out) >= flush_every:
+        stdout.write("\n".join(out) + "\n")
+        out.clear()
+
+
+lens = np.array([subword_lens[line.split()[0]] if line else -1 for line in lines], dtype=np.int32)
+decisions = assign_splits(lens, max_len)
+
+for line, decision in zip(lines, decisions):
+    if not line:
+        emit(line)
+        continue
+    if decision == SKIP:
+        continue
+    if decision == SPLIT:
+        emit("")
 
-        subword_len_counter += current_subwords_len
+    line = line.split()
+    emit(line[0] + " " + line[-1])
 
-        print(token, label)
\ No newline at end of file
+if out:
+    stdout.write("\n".join(out) + "\n")
+stdout.flush()
@@ -177,14 +177,20 @@ def get_parser(MODEL_TYPES, ALL_MODELS):
   parser.add_argument(
     "--fp16",
     action="store_true",
-    help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+    help="Whether to use 16-bit (mixed) precision (through torch.cuda.amp) instead of 32-bit",
   )
   parser.add_argument(
-    "--fp16_opt_level",
-    type=str,
-    default="O1",
-    help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-    "See details at https://nvidia.github.io/apex/amp.html",
+    "--bf16",
+    action="store_true",
+    help="Whether to use bfloat16 (mixed) precision (through torch.cuda.amp) instead of 32-bit",
+  )
+  parser.add_argument(
+    "--compile", action="store_true", help="Whether to compile the model with torch.compile for kernel fusion"
+  )
+  parser.add_argument(
+    "--cuda_graph",
+    action="store_true",
+    help="Whether to capture the training step in a CUDA graph (single GPU, no gradient accumulation)",
   )
   parser.add_argument("--server_ip", type=str, default="", help="Can be used for distant debugging.")
   parser.add_argument("--server_port", type=str, default="", help="Can be used for distant debugging.")
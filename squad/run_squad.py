@@ -15,34 +15,44 @@
 # limitations under the License.
 """ Finetuning the library models for question-answering on SQuAD (DistilBERT, Bert, XLM, XLNet)."""
 
+import contextlib
 import glob
 import logging
+import math
+import multiprocessing
 import os
 import random
 import timeit
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.optim import AdamW
+from torch.utils.data import DataLoader, Dataset, RandomSampler, TensorDataset
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
 from transformers import (
   MODEL_FOR_QUESTION_ANSWERING_MAPPING,
   WEIGHTS_NAME,
-  AdamW,
   AutoConfig,
   AutoModelForQuestionAnswering,
   AutoTokenizer,
   get_linear_schedule_with_warmup,
-  squad_convert_examples_to_features,
 )
 from transformers.data.metrics.squad_metrics import (
   compute_predictions_log_probs,
   compute_predictions_logits,
   squad_evaluate,
 )
-from transformers.data.processors.squad import SquadResult, SquadV1Processor, SquadV2Processor
+from transformers.data.processors.squad import (
+  SquadResult,
+  SquadV1Processor,
+  SquadV2Processor,
+  squad_convert_example_to_features,
+  squad_convert_example_to_features_init,
+)
 from arguments import get_parser
 
 try:
@@ -67,11 +77,149 @@ def set_seed(args):
     torch.cuda.manual_seed_all(args.seed)
 
 
-def to_list(tensor):
-  return tensor.detach().cpu().tolist()
+def to_host(tensor):
+  # Half precision logits are upcast so that numpy can represent bfloat16 as well
+  dtype = torch.float32 if tensor.is_floating_point() else tensor.dtype
+  return tensor.detach().to("cpu", dtype=dtype, non_blocking=True)
+
+
+def amp_dtype(args):
+  return torch.bfloat16 if args.bf16 else torch.float16
+
 
 def entropy(tensor):
-  return torch.sum(torch.log(tensor) * tensor, axis=-1)
+  return -torch.sum(torch.log(tensor.clamp_min(1e-12)) * tensor, axis=-1)
+
+
+def get_input_builder(args, model, batch_size):
+  """ Returns a function completing a batch into the model inputs, specialized once for the model type. """
+  # for lang_id-sensitive xlm models, the language ids are allocated once and sliced to every batch
+  if args.model_type in ["xlnet", "xlm"] and hasattr(model, "config") and hasattr(model.config, "lang2id"):
+    lang_ids = torch.full((batch_size, args.max_seq_length), args.lang_id, dtype=torch.int64, device=args.device)
+
+    def build_inputs(batch):
+      batch["langs"] = lang_ids[: batch["input_ids"].size(0), : batch["input_ids"].size(1)]
+      return batch
+
+    return build_inputs
+
+  return lambda batch: batch
+
+
+class AttentionEntropy(object):
+  """
+  Reduces each layer's attention probabilities to their mean entropy over the context tokens as soon as they are
+  computed, so the full attention maps never have to be returned by the model. Expects a single forward pass over
+  the whole batch, so it cannot be used with DataParallel.
+  """
+
+  def __init__(self, model):
+    model = model.module if hasattr(model, "module") else model
+    self.context_mask = None
+    self.entropies = []
+    # The attention dropout is the first module to receive the attention probabilities of a layer
+    for layer in model.base_model.encoder.layer:
+      layer.attention.self.dropout.register_forward_pre_hook(self._hook)
+
+  def _hook(self, module, inputs):
+    if self.context_mask is None:
+      return
+    # The entropies only feed the uncertainty head, so autograd must not keep (batch, heads, seq, seq) buffers alive
+    with torch.no_grad():
+      attention_entropy = entropy(inputs[0].detach()).masked_fill(~self.context_mask[:, None, :], 0.0)
+      self.entropies.append(attention_entropy.sum(dim=-1) / self.lengths[:, None])
+
+  def start(self, context_mask):
+    self.context_mask = context_mask
+    self.lengths = context_mask.sum(dim=-1).clamp_min(1)
+    self.entropies = []
+
+  def stop(self):
+    """ Returns the entropies of the last forward pass, of shape (batch, layers * heads). """
+    entropies = torch.stack(self.entropies, dim=1).flatten(1)
+    self.context_mask = None
+    self.entropies = []
+    return entropies
+
+
+class CudaGraphTrainStep(object):
+  """ Captures the forward and backward pass of a fixed-shape training step in a CUDA graph and replays it. """
+
+  def __init__(self, model, inputs, scaler, args, num_warmup_steps=3):
+    self.args = args
+    self.static_inputs = {k: v.clone() for k, v in inputs.items()}
+
+    # Warm up on a side stream so that lazy initialization does not end up in the graph
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+      for _ in range(num_warmup_steps):
+        scaler.scale(self._forward(model)).backward()
+    torch.cuda.current_stream().wait_stream(side_stream)
+
+    # Gradients allocated during capture are the static buffers every replay writes into
+    model.zero_grad(set_to_none=True)
+    self.graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(self.graph):
+      self.static_loss = self._forward(model)
+      scaler.scale(self.static_loss).backward()
+
+  def _forward(self, model):
+    with torch.cuda.amp.autocast(
+      enabled=self.args.fp16 or self.args.bf16, dtype=amp_dtype(self.args), cache_enabled=False
+    ):
+      return model(**self.static_inputs)[0]
+
+  def matches(self, inputs):
+    return inputs.keys() == self.static_inputs.keys() and all(
+      v.shape == self.static_inputs[k].shape for k, v in inputs.items()
+    )
+
+  def __call__(self, inputs):
+    for k, v in inputs.items():
+      self.static_inputs[k].copy_(v, non_blocking=True)
+    self.graph.replay()
+    return self.static_loss
+
+
+class CudaPrefetcher(object):
+  """ Iterates over a DataLoader while copying the next batch to the device on a side CUDA stream. """
+
+  def __init__(self, loader, device, skip=0):
+    self.loader = loader
+    self.device = device
+    # Batches to drop on the host before anything is copied, used when resuming training
+    self.skip = skip
+    self.stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+
+  def __len__(self):
+    return max(0, len(self.loader) - self.skip)
+
+  def __iter__(self):
+    loader_iter = iter(self.loader)
+    for _ in range(self.skip):
+      next(loader_iter, None)
+    batch = self._preload(loader_iter)
+    while batch is not None:
+      if self.stream is not None:
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        # Tensors were allocated on the side stream, make sure they are not reused while the main stream needs them
+        for t in batch.values():
+          t.record_stream(current_stream)
+      next_batch = self._preload(loader_iter)
+      yield batch
+      batch = next_batch
+
+  def _preload(self, loader_iter):
+    try:
+      batch = next(loader_iter)
+    except StopIteration:
+      return None
+    if self.stream is None:
+      return {k: v.to(self.device) for k, v in batch.items()}
+    with torch.cuda.stream(self.stream):
+      return {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
 
 
 def train(args, train_dataset, model, tokenizer, uncertainty_model=None):
@@ -81,7 +229,14 @@ def train(args, train_dataset, model, tokenizer, uncertainty_model=None):
 
   args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
   train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-  train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+  train_dataloader = DataLoader(
+    train_dataset,
+    sampler=train_sampler,
+    batch_size=args.train_batch_size,
+    pin_memory=args.n_gpu > 0,
+    num_workers=max(1, args.threads),
+    persistent_workers=True,
+  )
 
   if args.max_steps > 0:
     t_total = args.max_steps
@@ -98,13 +253,16 @@ def train(args, train_dataset, model, tokenizer, uncertainty_model=None):
     },
     {"params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], "weight_decay": 0.0},
   ]
-  optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
+  # The fused CUDA implementation updates all parameters in a single kernel launch
+  optimizer = AdamW(
+    optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon, fused=args.device.type == "cuda"
+  )
   scheduler = get_linear_schedule_with_warmup(
     optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total
   )
 
-  if uncertainty_model:
-    uncertainty_optimizer = torch.optim.Adam(uncertainty_model.parameters)
+  if uncertainty_model is not None:
+    uncertainty_optimizer = torch.optim.Adam(uncertainty_model.parameters(), fused=args.device.type == "cuda")
 
   # Check if saved optimizer or scheduler states exist
   if os.path.isfile(os.path.join(args.model_name_or_path, "optimizer.pt")) and os.path.isfile(
@@ -114,30 +272,54 @@ def train(args, train_dataset, model, tokenizer, uncertainty_model=None):
     optimizer.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "optimizer.pt")))
     scheduler.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "scheduler.pt")))
   
-  if uncertainty_model and os.path.isfile(os.path.join(args.model_name_or_path, "uncertainty_optimizer.pt")):
-    uncertainty_model.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "uncertainty_optimizer.pt")))
-
-  if args.fp16:
-    try:
-      from apex import amp
-    except ImportError:
-      raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
+  if uncertainty_model is not None and os.path.isfile(
+    os.path.join(args.model_name_or_path, "uncertainty_optimizer.pt")
+  ):
+    uncertainty_optimizer.load_state_dict(
+      torch.load(os.path.join(args.model_name_or_path, "uncertainty_optimizer.pt"))
+    )
 
-    model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
-    if uncertainty_model:
-      uncertainty_model, uncertainty_optimizer = amp.initialize(uncertainty_model, uncertainty_optimizer, opt_level=args.fp16_opt_level)
+  # Loss scaling is only needed for fp16, bf16 has the same exponent range as fp32
+  scaler = torch.cuda.amp.GradScaler(enabled=args.fp16)
 
-  # multi-gpu training (should be after apex fp16 initialization)
+  # multi-gpu training
   if args.n_gpu > 1:
     model = torch.nn.DataParallel(model)
-    uncertainty_model = torch.nn.DataParallel(uncertainty_model)
+    if uncertainty_model is not None:
+      uncertainty_model = torch.nn.DataParallel(uncertainty_model)
 
-  # Distributed training (should be after apex fp16 initialization)
+  # Distributed training
   if args.local_rank != -1:
+    # The set of used parameters is the same at every step, so a static graph lets DDP overlap
+    # the gradient all-reduce with the backward pass
     model = torch.nn.parallel.DistributedDataParallel(
-      model, device_ids=[args.local_rank], output_device=args.local_rank, find_unused_parameters=True
+      model,
+      device_ids=[args.local_rank],
+      output_device=args.local_rank,
+      bucket_cap_mb=50,
+      gradient_as_bucket_view=True,
+      static_graph=True,
     )
 
+  # CUDA graphs need a static, single-device step without accumulation across micro-batches
+  use_cuda_graph = (
+    args.cuda_graph
+    and args.device.type == "cuda"
+    and args.n_gpu == 1
+    and args.local_rank == -1
+    and args.gradient_accumulation_steps == 1
+    and not args.compile
+    and uncertainty_model is None
+  )
+  if args.cuda_graph and not use_cuda_graph:
+    logger.warning("CUDA graph capture is only supported for single GPU training without accumulation, disabling it")
+  graphed_step = None
+
+  if uncertainty_model is not None:
+    attention_entropy = AttentionEntropy(model)
+
+  build_inputs = get_input_builder(args, model, args.train_batch_size)
+
   # Train!
   logger.info("***** Running training *****")
   logger.info("  Num examples = %d", len(train_dataset))
@@ -171,8 +353,10 @@ def train(args, train_dataset, model, tokenizer, uncertainty_model=None):
     except ValueError:
       logger.info("  Starting fine-tuning.")
 
-  tr_loss, logging_loss = 0.0, 0.0
-  model.zero_grad()
+  # Accumulate the loss on device so we only synchronize with the GPU when logging
+  tr_loss = torch.zeros((), device=args.device)
+  logging_loss = torch.zeros_like(tr_loss)
+  model.zero_grad(set_to_none=True)
   train_iterator = trange(
     epochs_trained, int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0]
   )
@@ -180,84 +364,66 @@ def train(args, train_dataset, model, tokenizer, uncertainty_model=None):
   set_seed(args)
 
   for _ in train_iterator:
-    epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
-    for step, batch in enumerate(epoch_iterator):
+    # Skip past any already trained steps if resuming training
+    skipped_steps, steps_trained_in_current_epoch = steps_trained_in_current_epoch, 0
+    epoch_iterator = tqdm(
+      CudaPrefetcher(train_dataloader, args.device, skip=skipped_steps),
+      desc="Iteration",
+      disable=args.local_rank not in [-1, 0],
+    )
+    for step, batch in enumerate(epoch_iterator, start=skipped_steps):
+      model.train()
+      inputs = build_inputs(batch)
 
-      # Skip past any already trained steps if resuming training
-      if steps_trained_in_current_epoch > 0:
-        steps_trained_in_current_epoch -= 1
-        continue
+      if use_cuda_graph and graphed_step is None and inputs["input_ids"].size(0) == args.train_batch_size:
+        graphed_step = CudaGraphTrainStep(model, inputs, scaler, args)
 
-      model.train()
-      batch = tuple(t.to(args.device) for t in batch)
-
-      inputs = {
-        "input_ids": batch[0],
-        "attention_mask": batch[1],
-        "token_type_ids": batch[2],
-        "start_positions": batch[3],
-        "end_positions": batch[4],
-      }
-
-      if args.model_type in ["xlm", "roberta", "distilbert", "camembert"]:
-        del inputs["token_type_ids"]
-
-      if args.model_type in ["xlnet", "xlm"]:
-        inputs.update({"cls_index": batch[5], "p_mask": batch[6]})
-        if args.version_2_with_negative:
-          inputs.update({"is_impossible": batch[7]})
-        if hasattr(model, "config") and hasattr(model.config, "lang2id"):
-          inputs.update(
-            {"langs": (torch.ones(batch[0].shape, dtype=torch.int64) * args.lang_id).to(args.device)}
-          )
-
-      outputs = model(**inputs)
-      # model outputs are always tuple in transformers (see doc)
-      loss = outputs[0]
-      if uncertainty_model:
-        start_scores = outputs[1]
-        end_scores = outputs[2]
-        attentions = outputs[max(3, len(outputs)-1)]
-
-        start_scores[1-inputs['token_type_ids']] = -10000
-        end_scores[1-inputs['token_type_ids']] = -10000
-        start_scores = torch.softmax(start_scores, dim=-1)
-        end_scores = torch.softmax(end_scores, dim=-1)
-        scores = torch.stack(start_scores, end_scores, dim=0)
-
-        offsets = torch.sum(inputs['attention_mask'], axis=1) - torch.sum(inputs['token_type_ids'], axis=1)
-        ends = torch.sum(inputs['attention_mask'], axis=1)
-        lengths = (offsets - ends).flatten()
-        for idx, (offset, end) in enumerate(zip(offsets, ends)):
-          a = [entropy(attention[idx, :, offset:end, :]) / lengths[idx] for attention in attentions]
-          import pdb
-          pdb.set_trace()
-          
-
-
-        
-
-      if args.n_gpu > 1:
-        loss = loss.mean()  # mean() to average on multi-gpu parallel (not distributed) training
-      if args.gradient_accumulation_steps > 1:
-        loss = loss / args.gradient_accumulation_steps
-
-      if args.fp16:
-        with amp.scale_loss(loss, optimizer) as scaled_loss:
-          scaled_loss.backward()
+      if graphed_step is not None and graphed_step.matches(inputs):
+        loss = graphed_step(inputs)
       else:
-        loss.backward()
-
-      tr_loss += loss.item()
-      if (step + 1) % args.gradient_accumulation_steps == 0:
-        if args.fp16:
-          torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
+        if uncertainty_model is not None:
+          # Only the context segment (token_type_ids == 1) can hold the answer
+          context_mask = inputs["attention_mask"].bool() & inputs["token_type_ids"].bool()
+          attention_entropy.start(context_mask)
+
+        # Under DDP, only all-reduce gradients on the micro-batch that completes an accumulation step
+        if args.local_rank != -1 and (step + 1) % args.gradient_accumulation_steps != 0:
+          sync_context = model.no_sync()
         else:
-          torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+          sync_context = contextlib.nullcontext()
+
+        with sync_context:
+          with torch.cuda.amp.autocast(enabled=args.fp16 or args.bf16, dtype=amp_dtype(args)):
+            outputs = model(**inputs)
+          # model outputs are always tuple in transformers (see doc)
+          loss = outputs[0]
+          if uncertainty_model is not None:
+            start_scores = torch.softmax(outputs[1].detach().masked_fill(~context_mask, -10000.0), dim=-1)
+            end_scores = torch.softmax(outputs[2].detach().masked_fill(~context_mask, -10000.0), dim=-1)
+            scores = torch.stack((start_scores, end_scores), dim=0)
+            uncertainty_logits = uncertainty_model(attention_entropy.stop().float())
+
+          if args.n_gpu > 1:
+            loss = loss.mean()  # mean() to average on multi-gpu parallel (not distributed) training
+          if args.gradient_accumulation_steps > 1:
+            loss = loss / args.gradient_accumulation_steps
+
+          scaler.scale(loss).backward()
+
+        if uncertainty_model is not None:
+          # Not consumed yet, free them instead of keeping them alive through the next forward pass
+          del scores, uncertainty_logits
+
+      tr_loss += loss.detach()
+      if (step + 1) % args.gradient_accumulation_steps == 0:
+        scaler.unscale_(optimizer)
+        torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
         scheduler.step()  # Update learning rate schedule
-        model.zero_grad()
+        # The captured graph writes gradients into fixed buffers, so they must stay allocated
+        model.zero_grad(set_to_none=graphed_step is None)
         global_step += 1
 
         # Log metrics
@@ -268,8 +434,8 @@ def train(args, train_dataset, model, tokenizer, uncertainty_model=None):
             for key, value in results.items():
               tb_writer.add_scalar("eval_{}".format(key), value, global_step)
           tb_writer.add_scalar("lr", scheduler.get_lr()[0], global_step)
-          tb_writer.add_scalar("loss", (tr_loss - logging_loss) / args.logging_steps, global_step)
-          logging_loss = tr_loss
+          tb_writer.add_scalar("loss", (tr_loss - logging_loss).item() / args.logging_steps, global_step)
+          logging_loss.copy_(tr_loss)
 
         # Save model checkpoint
         if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
@@ -298,7 +464,7 @@ def train(args, train_dataset, model, tokenizer, uncertainty_model=None):
   if args.local_rank in [-1, 0]:
     tb_writer.close()
 
-  return global_step, tr_loss / global_step
+  return global_step, tr_loss.item() / global_step
 
 
 def evaluate(args, model, tokenizer, prefix=""):
@@ -309,9 +475,21 @@ def evaluate(args, model, tokenizer, prefix=""):
 
   args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
 
-  # Note that DistributedSampler samples randomly
-  eval_sampler = SequentialSampler(dataset)
-  eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+  # Batch features of similar length together so each batch can be trimmed to its own longest feature. Trimming
+  # is only valid for right padding, and compiled models are kept on the static max_seq_length shape.
+  lengths = dataset.tensors["attention_mask"].sum(dim=1)
+  order = torch.argsort(lengths, descending=True).tolist()
+  eval_batch_sampler = [order[i : i + args.eval_batch_size] for i in range(0, len(order), args.eval_batch_size)]
+  eval_dataloader = DataLoader(
+    dataset,
+    batch_sampler=eval_batch_sampler,
+    collate_fn=trim_to_longest if tokenizer.padding_side == "right" and not args.compile else None,
+    pin_memory=args.n_gpu > 0,
+    num_workers=max(1, args.threads),
+    persistent_workers=True,
+    # main() may be loading the next checkpoint in another thread, forking now could inherit its held locks
+    multiprocessing_context="spawn",
+  )
 
   # multi-gpu evaluate
   if args.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
@@ -322,42 +500,33 @@ def evaluate(args, model, tokenizer, prefix=""):
   logger.info("  Num examples = %d", len(dataset))
   logger.info("  Batch size = %d", args.eval_batch_size)
 
+  build_inputs = get_input_builder(args, model, args.eval_batch_size)
+
   all_results = []
   start_time = timeit.default_timer()
 
-  for batch in tqdm(eval_dataloader, desc="Evaluating"):
+  for batch in tqdm(CudaPrefetcher(eval_dataloader, args.device), desc="Evaluating"):
     model.eval()
-    batch = tuple(t.to(args.device) for t in batch)
 
     with torch.no_grad():
-      inputs = {
-        "input_ids": batch[0],
-        "attention_mask": batch[1],
-        "token_type_ids": batch[2],
-      }
-
-      if args.model_type in ["xlm", "roberta", "distilbert", "camembert"]:
-        del inputs["token_type_ids"]
-
-      feature_indices = batch[3]
-
-      # XLNet and XLM use more arguments for their predictions
-      if args.model_type in ["xlnet", "xlm"]:
-        inputs.update({"cls_index": batch[4], "p_mask": batch[5]})
-        # for lang_id-sensitive xlm models
-        if hasattr(model, "config") and hasattr(model.config, "lang2id"):
-          inputs.update(
-            {"langs": (torch.ones(batch[0].shape, dtype=torch.int64) * args.lang_id).to(args.device)}
-          )
-
-      outputs = model(**inputs)
-
-    for i, feature_index in enumerate(feature_indices):
-      # TODO: i and feature_index are the same number! Simplify by removing enumerate?
-      eval_feature = features[feature_index.item()]
+      feature_indices = batch.pop("feature_index")
+      inputs = build_inputs(batch)
+
+      with torch.cuda.amp.autocast(enabled=args.fp16 or args.bf16, dtype=amp_dtype(args)):
+        outputs = model(**inputs)
+
+    # Copy the whole batch to the host with a single synchronization instead of one per example
+    outputs = [to_host(output) for output in outputs]
+    feature_indices = to_host(feature_indices)
+    if args.device.type == "cuda":
+      torch.cuda.synchronize(args.device)
+    outputs = [output.numpy() for output in outputs]
+
+    for i, feature_index in enumerate(feature_indices.tolist()):
+      eval_feature = features[feature_index]
       unique_id = int(eval_feature.unique_id)
 
-      output = [to_list(output[i]) for output in outputs]
+      output = [output[i].tolist() for output in outputs]
 
       # Some models (XLNet, XLM) use 5 arguments for their predictions, while the other "simpler"
       # models only use two.
@@ -437,6 +606,204 @@ def evaluate(args, model, tokenizer, prefix=""):
   return results
 
 
+class DictDataset(Dataset):
+  """ Dataset of named tensors sharing their first dimension, indexed into a dict per example. """
+
+  def __init__(self, tensors):
+    self.tensors = tensors
+
+  def __len__(self):
+    return len(self.tensors["input_ids"])
+
+  def __getitem__(self, index):
+    return {k: v[index] for k, v in self.tensors.items()}
+
+
+def to_model_inputs_dataset(args, dataset, evaluate=False):
+  """ Names the positional tensors returned by squad_convert_examples_to_features after the model arguments. """
+  tensors = dataset.tensors
+  inputs = {"input_ids": tensors[0], "attention_mask": tensors[1]}
+  if args.model_type not in ["xlm", "roberta", "distilbert", "camembert"]:
+    inputs["token_type_ids"] = tensors[2]
+
+  if evaluate:
+    inputs["feature_index"] = tensors[3]
+    # XLNet and XLM use more arguments for their predictions
+    if args.model_type in ["xlnet", "xlm"]:
+      inputs.update({"cls_index": tensors[4], "p_mask": tensors[5]})
+  else:
+    inputs.update({"start_positions": tensors[3], "end_positions": tensors[4]})
+    if args.model_type in ["xlnet", "xlm"]:
+      inputs.update({"cls_index": tensors[5], "p_mask": tensors[6]})
+      if args.version_2_with_negative:
+        inputs.update({"is_impossible": tensors[7]})
+
+  return DictDataset(inputs)
+
+
+def trim_to_longest(examples):
+  """ Collates examples and cuts the padding shared by the whole batch off the sequence tensors. """
+  batch = default_collate(examples)
+  max_len = int(batch["attention_mask"].sum(dim=1).max())
+  for key in ["input_ids", "attention_mask", "token_type_ids", "p_mask"]:
+    if key in batch:
+      batch[key] = batch[key][:, :max_len].contiguous()
+  return batch
+
+
+def load_checkpoint(args, checkpoint):
+  model = AutoModelForQuestionAnswering.from_pretrained(checkpoint)  # , force_download=True)
+  if args.fp16 or args.bf16:
+    model.to(amp_dtype(args))
+  return model
+
+
+def cached_tensor_file(cached_features_file, index):
+  return "{}.{}.npy".format(cached_features_file, index)
+
+
+def cached_feature_shard_file(cached_features_file, index):
+  return "{}.features_{}".format(cached_features_file, index)
+
+
+def cached_examples_file(cached_features_file):
+  return "{}.examples".format(cached_features_file)
+
+
+def load_cached_features(cached_features_file, feature_shards):
+  """ Loads the per-chunk feature files and numbers them as a single squad_convert_examples_to_features call. """
+  features = []
+  for i, (feature_offset, example_offset) in enumerate(feature_shards):
+    for j, feature in enumerate(torch.load(cached_feature_shard_file(cached_features_file, i))):
+      feature.example_index += example_offset
+      feature.unique_id = 1000000000 + feature_offset + j
+      features.append(feature)
+  return features
+
+
+def load_cached_tensors(cached_features_file, num_tensors):
+  # Memory-map the tensors so nothing is read from disk until a batch needs it
+  return TensorDataset(
+    *(
+      torch.from_numpy(np.load(cached_tensor_file(cached_features_file, i), mmap_mode="c"))
+      for i in range(num_tensors)
+    )
+  )
+
+
+def _convert_chunk_init(tokenizer):
+  squad_convert_example_to_features_init(tokenizer)
+
+
+def _convert_chunk(job):
+  """ Converts one chunk of examples to features and writes the chunk's arrays and features to shard files. """
+  (chunk_index, examples), args, evaluate, shard_prefix = job
+  features = []
+  # Same numbering as squad_convert_examples_to_features, relative to the start of the chunk
+  example_index = 0
+  for example in examples:
+    example_features = squad_convert_example_to_features(
+      example,
+      max_seq_length=args.max_seq_length,
+      doc_stride=args.doc_stride,
+      max_query_length=args.max_query_length,
+      is_training=not evaluate,
+    )
+    if not example_features:
+      continue
+    for feature in example_features:
+      feature.example_index = example_index
+      features.append(feature)
+    example_index += 1
+
+  np.savez(
+    "{}.shard_{}.npz".format(shard_prefix, chunk_index), *features_to_arrays(features, evaluate, args.max_seq_length)
+  )
+  torch.save(features, cached_feature_shard_file(shard_prefix, chunk_index))
+  return chunk_index, len(features), example_index
+
+
+def features_to_arrays(features, evaluate, max_seq_length):
+  """ Same tensors as the dataset of squad_convert_examples_to_features, with a fixed shape even when empty. """
+  arrays = [
+    np.array([f.input_ids for f in features], dtype=np.int64).reshape(-1, max_seq_length),
+    np.array([f.attention_mask for f in features], dtype=np.int64).reshape(-1, max_seq_length),
+    np.array([f.token_type_ids for f in features], dtype=np.int64).reshape(-1, max_seq_length),
+  ]
+  if evaluate:
+    arrays.append(np.arange(len(features), dtype=np.int64))
+  else:
+    arrays.append(np.array([f.start_position for f in features], dtype=np.int64))
+    arrays.append(np.array([f.end_position for f in features], dtype=np.int64))
+  arrays.append(np.array([f.cls_index for f in features], dtype=np.int64))
+  arrays.append(np.array([f.p_mask for f in features], dtype=np.float32).reshape(-1, max_seq_length))
+  if not evaluate:
+    arrays.append(np.array([f.is_impossible for f in features], dtype=np.float32))
+  return arrays
+
+
+def convert_examples_to_features(args, tokenizer, examples, evaluate, cached_features_file, chunk_size=10000):
+  """
+  Converts examples to features in chunks spread over a process pool. Each chunk's tensors and features are
+  streamed to shards on disk, the tensor shards are then concatenated into the memory-mapped cache files. Only
+  counts come back from the workers, so features never have to be held in memory here.
+
+  Returns the cache metadata: the number of tensors and the numbering offsets of every feature shard.
+  """
+  # Keep several chunks per worker so that every core stays busy, also on small datasets
+  threads = max(1, args.threads)
+  chunk_size = max(1, min(chunk_size, math.ceil(len(examples) / (4 * threads))))
+  chunks = [examples[i : i + chunk_size] for i in range(0, len(examples), chunk_size)]
+  jobs = [(chunk, args, evaluate, cached_features_file) for chunk in enumerate(chunks)]
+  chunk_num_features = [0] * len(chunks)
+  chunk_num_examples = [0] * len(chunks)
+  # Spawn rather than fork, another thread may be loading a checkpoint and holding locks at this point
+  with multiprocessing.get_context("spawn").Pool(
+    threads, initializer=_convert_chunk_init, initargs=(tokenizer,)
+  ) as pool:
+    for chunk_index, num_features, num_examples in tqdm(
+      pool.imap_unordered(_convert_chunk, jobs), total=len(jobs), desc="convert squad examples to features"
+    ):
+      chunk_num_features[chunk_index] = num_features
+      chunk_num_examples[chunk_index] = num_examples
+
+  # Offsets that number the features of every shard globally, see load_cached_features
+  feature_shards = []
+  feature_offset, example_offset = 0, 0
+  for num_features, num_examples in zip(chunk_num_features, chunk_num_examples):
+    feature_shards.append((feature_offset, example_offset))
+    feature_offset += num_features
+    example_offset += num_examples
+
+  shard_files = ["{}.shard_{}.npz".format(cached_features_file, i) for i in range(len(chunks))]
+  outputs = [
+    np.lib.format.open_memmap(
+      cached_tensor_file(cached_features_file, i),
+      mode="w+",
+      dtype=array.dtype,
+      shape=(feature_offset,) + array.shape[1:],
+    )
+    for i, array in enumerate(features_to_arrays([], evaluate, args.max_seq_length))
+  ]
+  num_tensors = len(outputs)
+
+  for shard_file, num_features, (offset, _) in zip(shard_files, chunk_num_features, feature_shards):
+    if num_features:
+      with np.load(shard_file) as shard:
+        for i, output in enumerate(outputs):
+          output[offset : offset + num_features] = shard["arr_{}".format(i)]
+      # Feature indices in the eval set were local to the shard
+      if evaluate:
+        outputs[3][offset : offset + num_features] += offset
+    os.remove(shard_file)
+
+  for output in outputs:
+    output.flush()
+  del outputs
+
+  return {"num_tensors": num_tensors, "feature_shards": feature_shards}
+
+
 def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=False):
   if args.local_rank not in [-1, 0] and not evaluate:
     # Make sure only the first process in distributed training process the dataset, and the others will use the cache
@@ -454,14 +821,15 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
   )
 
   # Init features and dataset from cache if it exists
-  if os.path.exists(cached_features_file) and not args.overwrite_cache:
+  if (
+    os.path.exists(cached_features_file)
+    and os.path.exists(cached_examples_file(cached_features_file))
+    and os.path.exists(cached_tensor_file(cached_features_file, 0))
+    and not args.overwrite_cache
+  ):
     logger.info("Loading features from cached file %s", cached_features_file)
-    features_and_dataset = torch.load(cached_features_file)
-    features, dataset, examples = (
-      features_and_dataset["features"],
-      features_and_dataset["dataset"],
-      features_and_dataset["examples"],
-    )
+    cache_metadata = torch.load(cached_features_file)
+    examples = None
   else:
     logger.info("Creating features from dataset file at %s", input_dir)
 
@@ -483,26 +851,25 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
       else:
         examples = processor.get_train_examples(args.data_dir, filename=args.train_file)
 
-    features, dataset = squad_convert_examples_to_features(
-      examples=examples,
-      tokenizer=tokenizer,
-      max_seq_length=args.max_seq_length,
-      doc_stride=args.doc_stride,
-      max_query_length=args.max_query_length,
-      is_training=not evaluate,
-      return_dataset="pt",
-      threads=args.threads,
-    )
+    cache_metadata = convert_examples_to_features(args, tokenizer, examples, evaluate, cached_features_file)
 
     if args.local_rank in [-1, 0]:
       logger.info("Saving features into cached file %s", cached_features_file)
-      torch.save({"features": features, "dataset": dataset, "examples": examples}, cached_features_file)
+      torch.save(examples, cached_examples_file(cached_features_file))
+      torch.save(cache_metadata, cached_features_file)
 
   if args.local_rank == 0 and not evaluate:
     # Make sure only the first process in distributed training process the dataset, and the others will use the cache
     torch.distributed.barrier()
 
+  dataset = load_cached_tensors(cached_features_file, cache_metadata["num_tensors"])
+  dataset = to_model_inputs_dataset(args, dataset, evaluate=evaluate)
+
+  # The python-side examples and features are only needed to post-process predictions
   if output_examples:
+    if examples is None:
+      examples = torch.load(cached_examples_file(cached_features_file))
+    features = load_cached_features(cached_features_file, cache_metadata["feature_shards"])
     return dataset, examples, features
   return dataset
 
@@ -550,6 +917,12 @@ def main():
     args.n_gpu = 1
   args.device = device
 
+  if args.uncertainty_model and args.n_gpu > 1:
+    # The attention entropy hooks see one replica's slice of the batch at a time under DataParallel
+    raise ValueError(
+      "--uncertainty_model is not supported with DataParallel, use a single GPU or distributed training."
+    )
+
   # Setup logging
   logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
@@ -577,7 +950,6 @@ def main():
   config = AutoConfig.from_pretrained(
     args.config_name if args.config_name else args.model_name_or_path,
     cache_dir=args.cache_dir if args.cache_dir else None,
-    output_attentions = args.uncertainty_model
   )
   tokenizer = AutoTokenizer.from_pretrained(
     args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
@@ -607,19 +979,11 @@ def main():
     torch.distributed.barrier()
 
   model.to(args.device)
-  
-  logger.info("Training/evaluation parameters %s", args)
-
-  # Before we do anything with models, we want to ensure that we get fp16 execution of torch.einsum if args.fp16 is set.
-  # Otherwise it'll default to "promote" mode, and we'll get fp32 operations. Note that running `--fp16_opt_level="O2"` will
-  # remove the need for this code, but it is still valid.
-  if args.fp16:
-    try:
-      import apex
+  # Every batch is padded to max_seq_length, so the compiled graph never needs to handle dynamic shapes
+  if args.compile:
+    model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
 
-      apex.amp.register_half_function(torch, "einsum")
-    except ImportError:
-      raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
+  logger.info("Training/evaluation parameters %s", args)
 
   # Training
   if args.do_train:
@@ -669,17 +1033,24 @@ def main():
 
     logger.info("Evaluate the following checkpoints: %s", checkpoints)
 
-    for checkpoint in checkpoints:
-      # Reload the model
-      global_step = checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
-      model = AutoModelForQuestionAnswering.from_pretrained(checkpoint)  # , force_download=True)
-      model.to(args.device)
-
-      # Evaluate
-      result = evaluate(args, model, tokenizer, prefix=global_step)
-
-      result = dict((k + ("_{}".format(global_step) if global_step else ""), v) for k, v in result.items())
-      results.update(result)
+    # Load the next checkpoint in the background while the current one is being evaluated
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      next_model = executor.submit(load_checkpoint, args, checkpoints[0]) if checkpoints else None
+      for i, checkpoint in enumerate(checkpoints):
+        # Reload the model
+        global_step = checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
+        model = next_model.result()
+        if i + 1 < len(checkpoints):
+          next_model = executor.submit(load_checkpoint, args, checkpoints[i + 1])
+        model.to(args.device)
+        if args.compile:
+          model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+
+        # Evaluate
+        result = evaluate(args, model, tokenizer, prefix=global_step)
+
+        result = dict((k + ("_{}".format(global_step) if global_step else ""), v) for k, v in result.items())
+        results.update(result)
 
   logger.info("Results: {}".format(results))
 